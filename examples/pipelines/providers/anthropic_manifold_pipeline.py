@@ -5,16 +5,17 @@ date: 2025-7-15
 version: 1.5
 license: MIT
 description: A pipeline for generating text and processing images using the Anthropic API.
-requirements: requests, sseclient-py
+requirements: httpx[http2], orjson
 environment_variables: ANTHROPIC_API_KEY
 """
 
 import os
-import requests
-import json
-from typing import List, Union, Generator, Iterator
+import asyncio
+import httpx
+import orjson
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple, Union, AsyncGenerator
 from pydantic import BaseModel
-import sseclient
 
 # Rundown Imports
 import tiktoken
@@ -22,9 +23,404 @@ import tiktoken
 from utils.pipelines.main import pop_system_message
 
 
+@lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    """
+    Loading the BPE ranks is expensive, so build each encoding once per process.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+# Minimum prompt length (in tokens) Anthropic will cache
+CACHE_MIN_TOKENS = 1024
+# Maximum number of cache_control breakpoints per request
+MAX_CACHE_BREAKPOINTS = 4
+# Requests with breakpoints to observe before giving up on caching a model
+CACHE_PROBE_REQUESTS = 5
+
+
+def _cache_bound(text: str) -> Optional[bool]:
+    """
+    Cheap check for whether a text block reaches CACHE_MIN_TOKENS.
+
+    Every token covers at least one UTF-8 byte, so shorter texts can never
+    qualify; very long texts are assumed to. Returns None for the band in
+    between, which needs an exact BPE count. This is a caching heuristic,
+    not a billing count.
+    """
+    if len(text) > CACHE_MIN_TOKENS * 8:
+        return True
+    if len(text.encode("utf-8")) < CACHE_MIN_TOKENS:
+        return False
+    return None
+
+
+def _image_size(url: str) -> int:
+    """
+    Decoded size in bytes of a base64 image data URL, computed from its
+    length so the payload is neither sliced nor decoded. Images referenced
+    by URL count as 0.
+    """
+    if not url.startswith("data:image"):
+        return 0
+    comma = url.find(",")
+    if comma == -1:
+        raise ValueError("Malformed image data URL")
+    padding = url.endswith("=") + url.endswith("==")
+    return (((len(url) - comma - 1) * 3) >> 2) - padding
+
+
+def _process_image(image_data: dict) -> dict:
+    url = image_data["url"]
+    if url.startswith("data:image"):
+        # Slice around the comma so the (possibly huge) payload is only
+        # copied once
+        comma = url.find(",")
+        if comma == -1:
+            raise ValueError("Malformed image data URL")
+        media_type = url[5:comma].split(";", 1)[0]
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": url[comma + 1 :],
+            },
+        }
+    else:
+        return {
+            "type": "image",
+            "source": {"type": "url", "url": url},
+        }
+
+
+def _build_processed_messages(
+    messages: List[dict], cache_enabled: bool, max_images: int, max_image_bytes: int
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Convert OpenAI-style messages into Anthropic content blocks.
+
+    Returns the messages together with their text blocks in prompt order, the
+    candidates for a cache breakpoint. The text blocks are left empty when
+    caching is off so no token work happens at all. Kept free of Pipeline
+    state and fully annotated so it can be compiled with mypyc if needed.
+    """
+    processed_messages: List[dict] = []
+    text_blocks: List[dict] = []
+    image_count = 0
+    total_image_size = 0
+
+    # Enforce the image limits before any payload is copied
+    for message in messages:
+        if not isinstance(message.get("content"), list):
+            continue
+        for item in message["content"]:
+            if item["type"] != "image_url":
+                continue
+
+            image_count += 1
+            if image_count > max_images:
+                raise ValueError(
+                    f"Maximum of {max_images} images per API call exceeded"
+                )
+
+            total_image_size += _image_size(item["image_url"]["url"])
+            if total_image_size > max_image_bytes:
+                raise ValueError(
+                    "Total size of images exceeds "
+                    f"{max_image_bytes // (1024 * 1024)} MB limit"
+                )
+
+    for message in messages:
+        if isinstance(message.get("content"), list):
+            processed_content = [
+                (
+                    {"type": "text", "text": item["text"]}
+                    if item["type"] == "text"
+                    else _process_image(item["image_url"])
+                )
+                for item in message["content"]
+                if item["type"] in ("text", "image_url")
+            ]
+
+            if cache_enabled:
+                text_blocks.extend(
+                    block for block in processed_content if block["type"] == "text"
+                )
+        else:
+            text_content = {"type": "text", "text": message.get("content", "")}
+            if cache_enabled:
+                text_blocks.append(text_content)
+            processed_content = [text_content]
+
+        processed_messages.append(
+            {"role": message["role"], "content": processed_content}
+        )
+
+    return processed_messages, text_blocks
+
+
+async def _aiter_sse_data(
+    response: httpx.Response,
+) -> AsyncGenerator[bytearray, None]:
+    """
+    Yield the payload of every `data:` line in a server-sent event stream.
+
+    Anthropic puts one JSON document on each data line and repeats the event
+    name in its "type" field, so lines are split on raw bytes and everything
+    else is skipped without decoding.
+    """
+    # Chunks are used as the transport delivers them; asking httpx for fixed
+    # size chunks would hold tokens back until the chunk fills up
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        end = buffer.rfind(b"\n")
+        if end == -1:
+            continue
+        # Only complete lines are split, the partial tail stays in place
+        for line in buffer[:end].split(b"\n"):
+            if line.startswith(b"data:"):
+                yield line[5:]
+        del buffer[: end + 1]
+    if buffer.startswith(b"data:"):
+        yield buffer[5:]
+
+
+class _MicroBatcher:
+    """
+    Collects items from concurrent callers and handles them in batches.
+
+    Everything queued within `window` seconds, up to `max_batch` items, is
+    passed to `_handle` at once. Each item carries a future that `_handle`
+    resolves; `close` fails whatever is still unresolved so no caller is left
+    waiting.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._task = None
+        # Futures handed out and not yet resolved, queued or being processed
+        self._pending = set()
+
+    def _put(self, item) -> asyncio.Future:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        self._queue.put_nowait((item, future))
+        return future
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._queue = None
+
+        for future in list(self._pending):
+            if not future.done():
+                future.set_exception(Exception("Error: pipeline is shutting down"))
+        self._pending.clear()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Give other requests a moment to join the batch
+            await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._handle(batch)
+
+    async def _handle(self, batch: List[tuple]):
+        raise NotImplementedError
+
+
+class _BatchingEncoder(_MicroBatcher):
+    """
+    Token counter shared by concurrent pipe calls.
+
+    Texts queued within a short window are counted together with one
+    `count_batch` call (encode_ordinary_batch), which releases the GIL and
+    spreads the BPE work for all waiting requests across threads.
+    """
+
+    def __init__(
+        self,
+        count_batch: Callable[[List[str]], List[int]],
+        window: float = 0.002,
+        max_batch: int = 256,
+    ):
+        super().__init__(window, max_batch)
+        self.count_batch = count_batch
+
+    async def count(self, texts: List[str]) -> List[int]:
+        return await asyncio.gather(*[self._put(text) for text in texts])
+
+    async def _handle(self, batch: List[tuple]):
+        try:
+            token_counts = await asyncio.to_thread(
+                self.count_batch, [text for text, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), tokens in zip(batch, token_counts):
+            # The caller may have gone away in the meantime
+            if not future.done():
+                future.set_result(tokens)
+
+
+class _BatchRejected(Exception):
+    """
+    The Message Batches API refused to create a batch.
+    """
+
+
+class _MessageBatcher(_MicroBatcher):
+    """
+    Sends non-streaming requests through the Message Batches API.
+
+    Payloads queued within a short window are submitted as one batch, which
+    is billed at half price. Batches are processed asynchronously by the API
+    and can take minutes to finish, so results are polled for.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        window: float = 0.025,
+        poll_interval: float = 5.0,
+        max_batch: int = 1000,
+    ):
+        super().__init__(window, max_batch)
+        self.client = client
+        self.url = url
+        self.poll_interval = poll_interval
+        self._batches = set()
+
+    async def submit(self, payload: dict) -> dict:
+        return await self._put(payload)
+
+    async def close(self):
+        for task in list(self._batches):
+            task.cancel()
+        self._batches.clear()
+        await super().close()
+
+    async def _handle(self, batch: List[tuple]):
+        # Poll in the background so new requests keep being batched
+        task = asyncio.create_task(self._process(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _process(self, batch: List[tuple]):
+        futures = {f"request-{i}": future for i, (_, future) in enumerate(batch)}
+        try:
+            response = await self.client.post(
+                self.url,
+                content=orjson.dumps(
+                    {
+                        "requests": [
+                            {"custom_id": custom_id, "params": payload}
+                            for custom_id, (payload, _) in zip(futures, batch)
+                        ]
+                    }
+                ),
+            )
+            if response.status_code != 200:
+                # One bad payload rejects the whole batch, let every caller
+                # retry on its own instead of sharing the error
+                raise _BatchRejected(
+                    f"Error: {response.status_code} - {response.text}"
+                )
+            status = orjson.loads(response.content)
+
+            while status["processing_status"] != "ended":
+                await asyncio.sleep(self.poll_interval)
+                response = await self.client.get(f"{self.url}/{status['id']}")
+                if response.status_code != 200:
+                    raise Exception(
+                        f"Error: {response.status_code} - {response.text}"
+                    )
+                status = orjson.loads(response.content)
+
+            response = await self.client.get(status["results_url"])
+            if response.status_code != 200:
+                raise Exception(f"Error: {response.status_code} - {response.text}")
+
+            # Results are JSON lines, in no particular order
+            for line in response.content.splitlines():
+                if not line.strip():
+                    continue
+                entry = orjson.loads(line)
+                future = futures.pop(entry["custom_id"], None)
+                if future is None or future.done():
+                    continue
+                result = entry["result"]
+                if result["type"] == "succeeded":
+                    future.set_result(result["message"])
+                else:
+                    future.set_exception(
+                        Exception(
+                            f"Error: batch request {result['type']} - "
+                            f"{result.get('error')}"
+                        )
+                    )
+        except asyncio.CancelledError:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(Exception("Error: batch was cancelled"))
+            raise
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(Exception("Error: no batch result returned"))
+
+
 class Pipeline:
+    # Models that accept cache_control breakpoints
+    _CACHE_CAPABLE = frozenset(
+        {
+            "claude-3-5-sonnet-20241022",
+            "claude-3-7-sonnet-latest",
+            "claude-sonnet-4-20250514",
+            "claude-opus-4-20250514",
+        }
+    )
+
+    # Request parameters taken from the body when present
+    _PAYLOAD_DEFAULTS = {
+        "max_tokens": 4096,
+        "temperature": 0.8,
+        "top_k": 40,
+        "top_p": 0.9,
+        "stream": False,
+    }
+    # Body keys that must not reach the API
+    _BODY_DROP = ("user", "chat_id", "title")
+    # Per-request image limits
+    _MAX_IMAGES = 5
+    _MAX_IMAGE_BYTES = 100 * 1024 * 1024
+
     class Valves(BaseModel):
         ANTHROPIC_API_KEY: str = ""
+        # Send non-streaming requests through the (slower, cheaper) batch API.
+        # Requests in a window share one batch; if the API rejects it, e.g.
+        # because one payload is malformed, each request is resent on its own
+        USE_MESSAGE_BATCHES: bool = False
 
     def __init__(self):
         self.type = "manifold"
@@ -35,7 +431,25 @@ class Pipeline:
             **{"ANTHROPIC_API_KEY": os.getenv("ANTHROPIC_API_KEY", "your-api-key-here")}
         )
         self.url = "https://api.anthropic.com/v1/messages"
-        self.update_headers()
+
+        self.headers = {
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+            "x-api-key": self.valves.ANTHROPIC_API_KEY,
+        }
+
+        # A single HTTP/2 connection multiplexes concurrent calls
+        self.client = httpx.AsyncClient(
+            http2=True,
+            headers=self.headers,
+            timeout=httpx.Timeout(60.0, read=None),
+            limits=httpx.Limits(max_connections=32),
+        )
+
+        # Prompt caching usage reported by the API, per model
+        self.cache_usage = {}
+        self.encoder = _BatchingEncoder(self.get_tokens_batch)
+        self.batcher = _MessageBatcher(self.client, f"{self.url}/batches")
 
     # Token count function for caching
     @staticmethod
@@ -43,17 +457,60 @@ class Pipeline:
         """
         Function to get total # of tokens in a given message.
         """
-        encoding = tiktoken.encoding_for_model("gpt-4o")
-        system_tokens = len(encoding.encode(text))
+        # encode_ordinary skips the special-token scan (and the ValueError
+        # plain encode raises when user text contains e.g. "<|endoftext|>")
+        return len(_get_encoding("gpt-4o").encode_ordinary(text))
+
+    @staticmethod
+    def get_tokens_batch(texts):
+        """
+        Function to get the # of tokens for several messages in one call.
+        """
+        if len(texts) == 1:
+            return [Pipeline.get_tokens(texts[0])]
+        encoded = _get_encoding("gpt-4o").encode_ordinary_batch(
+            texts, num_threads=os.cpu_count() or 1
+        )
+        return [len(tokens) for tokens in encoded]
+
+    def record_usage(self, model_id: str, usage: dict, cached: bool):
+        stats = self.cache_usage.setdefault(
+            model_id,
+            {
+                "cached_requests": 0,
+                "input_tokens": 0,
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 0,
+            },
+        )
+        if cached:
+            stats["cached_requests"] += 1
+        for key in (
+            "input_tokens",
+            "cache_creation_input_tokens",
+            "cache_read_input_tokens",
+        ):
+            stats[key] += usage.get(key) or 0
 
-        return system_tokens
+    def cache_working(self, model_id: str) -> bool:
+        """
+        Whether breakpoints on this model have led to any cache writes or reads.
+
+        Models are given CACHE_PROBE_REQUESTS requests with breakpoints before
+        the token counting for them is skipped.
+        """
+        stats = self.cache_usage.get(model_id)
+        if stats is None or stats["cached_requests"] < CACHE_PROBE_REQUESTS:
+            return True
+        return (
+            stats["cache_creation_input_tokens"] > 0
+            or stats["cache_read_input_tokens"] > 0
+        )
 
     def update_headers(self):
-        self.headers = {
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json",
-            "x-api-key": self.valves.ANTHROPIC_API_KEY,
-        }
+        # Only the API key depends on the valves
+        self.headers["x-api-key"] = self.valves.ANTHROPIC_API_KEY
+        self.client.headers["x-api-key"] = self.valves.ANTHROPIC_API_KEY
 
     def get_anthropic_models(self):
         return [
@@ -64,11 +521,14 @@ class Pipeline:
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
-        pass
+        # Valves may have been replaced from valves.json since __init__
+        self.update_headers()
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
-        pass
+        await self.client.aclose()
+        await self.encoder.close()
+        await self.batcher.close()
 
     async def on_valves_updated(self):
         self.update_headers()
@@ -77,147 +537,142 @@ class Pipeline:
         return self.get_anthropic_models()
 
     def process_image(self, image_data):
-        if image_data["url"].startswith("data:image"):
-            mime_type, base64_data = image_data["url"].split(",", 1)
-            media_type = mime_type.split(":")[1].split(";")[0]
-            return {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": media_type,
-                    "data": base64_data,
-                },
-            }
-        else:
-            return {
-                "type": "image",
-                "source": {"type": "url", "url": image_data["url"]},
-            }
+        return _process_image(image_data)
+
+    async def add_cache_breakpoints(self, text_blocks: List[dict]) -> bool:
+        """
+        Mark the last large text blocks of the prompt with cache_control.
+
+        The cache matches the longest prefix ending at a breakpoint, so only
+        the last MAX_CACHE_BREAKPOINTS eligible blocks are worth marking (the
+        API rejects more). Blocks are examined from the end, and each round
+        counts no more borderline texts than there are breakpoints left to
+        fill, so earlier blocks are only counted when later ones fall short.
+        """
+        remaining = reversed(text_blocks)
+        breakpoints = 0
+        exhausted = False
+        while breakpoints < MAX_CACHE_BREAKPOINTS and not exhausted:
+            # Take just enough possible candidates to fill the open slots
+            window = []
+            for text_content in remaining:
+                eligible = _cache_bound(text_content["text"])
+                if eligible is False:
+                    continue
+                window.append((text_content, eligible))
+                if len(window) == MAX_CACHE_BREAKPOINTS - breakpoints:
+                    break
+            else:
+                exhausted = True
+
+            # Count the borderline texts of this round in a single batch
+            pending = [
+                text_content for text_content, eligible in window if eligible is None
+            ]
+            token_counts = iter(())
+            if pending:
+                token_counts = iter(
+                    await self.encoder.count(
+                        [text_content["text"] for text_content in pending]
+                    )
+                )
 
-    def pipe(
+            for text_content, eligible in window:
+                if eligible is None:
+                    eligible = next(token_counts) >= CACHE_MIN_TOKENS
+                if eligible:
+                    # Add cache type
+                    text_content["cache_control"] = {"type": "ephemeral"}
+                    breakpoints += 1
+
+        return breakpoints > 0
+
+    async def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
-    ) -> Union[str, Generator, Iterator]:
+    ) -> Union[str, AsyncGenerator]:
         try:
             # Remove unnecessary keys
-            for key in ["user", "chat_id", "title"]:
+            for key in self._BODY_DROP:
                 body.pop(key, None)
 
             system_message, messages = pop_system_message(messages)
 
-            processed_messages = []
-            image_count = 0
-            total_image_size = 0
-            cached = False
+            cache_enabled = model_id in self._CACHE_CAPABLE and self.cache_working(
+                model_id
+            )
+            processed_messages, text_blocks = _build_processed_messages(
+                messages, cache_enabled, self._MAX_IMAGES, self._MAX_IMAGE_BYTES
+            )
 
-            for message in messages:
-                processed_content = []
-                if isinstance(message.get("content"), list):
-                    for item in message["content"]:
-                        if item["type"] == "text":
-                            # Check for caching
-                            text_content = {"type": "text", "text": item["text"]}
-                            if (
-                                model_id == "claude-3-5-sonnet-20241022"
-                                and self.get_tokens(item["text"]) >= 1024
-                            ):
-                                # Add cache type
-                                text_content["cache_control"] = {"type": "ephemeral"}
-                                cached = True
-                            processed_content.append(text_content)
-                        elif item["type"] == "image_url":
-                            if image_count >= 5:
-                                raise ValueError(
-                                    "Maximum of 5 images per API call exceeded"
-                                )
-
-                            processed_image = self.process_image(item["image_url"])
-                            processed_content.append(processed_image)
-
-                            if processed_image["source"]["type"] == "base64":
-                                image_size = (
-                                    len(processed_image["source"]["data"]) * 3 / 4
-                                )
-                            else:
-                                image_size = 0
-
-                            total_image_size += image_size
-                            if total_image_size > 100 * 1024 * 1024:
-                                raise ValueError(
-                                    "Total size of images exceeds 100 MB limit"
-                                )
-
-                            image_count += 1
-                else:
-                    # Check for caching
-                    text = message.get("content", "")
-                    text_content = {"type": "text", "text": text}
-                    if (
-                        model_id == "claude-3-5-sonnet-20241022"
-                        and self.get_tokens(text) >= 1024
-                    ):
-                        # Add cache type
-                        text_content["cache_control"] = {"type": "ephemeral"}
-                        cached = True
-                    processed_content = [text_content]
-
-                processed_messages.append(
-                    {"role": message["role"], "content": processed_content}
-                )
+            cached = False
+            if cache_enabled:
+                cached = await self.add_cache_breakpoints(text_blocks)
 
             # Prepare the payload
             payload = {
                 "model": model_id,
                 "messages": processed_messages,
-                "max_tokens": body.get("max_tokens", 4096),
-                "temperature": body.get("temperature", 0.8),
-                "top_k": body.get("top_k", 40),
-                "top_p": body.get("top_p", 0.9),
+                **self._PAYLOAD_DEFAULTS,
+                **{key: body[key] for key in self._PAYLOAD_DEFAULTS if key in body},
                 "stop_sequences": body.get("stop", []),
                 **({"system": str(system_message)} if system_message else {}),
-                "stream": body.get("stream", False),
             }
 
             # Add caching headers -- obsolete?
             # if cached:
             #    self.headers["anthropic-beta"] = "prompt-caching-2024-07-31"
 
-            if body.get("stream", False):
-                return self.stream_response(payload)
+            if payload["stream"]:
+                return self.stream_response(payload, cached)
             else:
-                return self.get_completion(payload)
+                return await self.get_completion(payload, cached)
         except Exception as e:
             return f"Error: {e}"
 
-    def stream_response(self, payload: dict) -> Generator:
-        response = requests.post(
-            self.url, headers=self.headers, json=payload, stream=True
-        )
+    async def stream_response(
+        self, payload: dict, cached: bool = False
+    ) -> AsyncGenerator:
+        # The content-type header is already set on the client
+        async with self.client.stream(
+            "POST", self.url, content=orjson.dumps(payload)
+        ) as response:
+            if response.status_code == 200:
+                async for event_data in _aiter_sse_data(response):
+                    try:
+                        data = orjson.loads(event_data)
+                        if data["type"] == "message_start":
+                            # Input and cache usage is only reported up front
+                            self.record_usage(
+                                payload["model"], data["message"]["usage"], cached
+                            )
+                        elif data["type"] == "content_block_start":
+                            yield data["content_block"]["text"]
+                        elif data["type"] == "content_block_delta":
+                            yield data["delta"]["text"]
+                        elif data["type"] == "message_stop":
+                            break
+                    except orjson.JSONDecodeError:
+                        print(f"Failed to parse JSON: {event_data}")
+                    except KeyError as e:
+                        print(f"Unexpected data structure: {e}")
+                        print(f"Full data: {data}")
+            else:
+                await response.aread()
+                raise Exception(f"Error: {response.status_code} - {response.text}")
 
-        if response.status_code == 200:
-            client = sseclient.SSEClient(response)
-            for event in client.events():
-                try:
-                    data = json.loads(event.data)
-                    if data["type"] == "content_block_start":
-                        yield data["content_block"]["text"]
-                    elif data["type"] == "content_block_delta":
-                        yield data["delta"]["text"]
-                    elif data["type"] == "message_stop":
-                        break
-                except json.JSONDecodeError:
-                    print(f"Failed to parse JSON: {event.data}")
-                except KeyError as e:
-                    print(f"Unexpected data structure: {e}")
-                    print(f"Full data: {data}")
-        else:
-            raise Exception(f"Error: {response.status_code} - {response.text}")
-
-    def get_completion(self, payload: dict) -> str:
-        response = requests.post(self.url, headers=self.headers, json=payload)
-        if response.status_code == 200:
-            res = response.json()
-            return (
-                res["content"][0]["text"] if "content" in res and res["content"] else ""
-            )
-        else:
-            raise Exception(f"Error: {response.status_code} - {response.text}")
+    async def get_completion(self, payload: dict, cached: bool = False) -> str:
+        res = None
+        if self.valves.USE_MESSAGE_BATCHES:
+            try:
+                res = await self.batcher.submit(payload)
+            except _BatchRejected:
+                pass
+
+        if res is None:
+            response = await self.client.post(self.url, content=orjson.dumps(payload))
+            if response.status_code != 200:
+                raise Exception(f"Error: {response.status_code} - {response.text}")
+            res = orjson.loads(response.content)
+
+        self.record_usage(payload["model"], res.get("usage", {}), cached)
+        return res["content"][0]["text"] if "content" in res and res["content"] else ""
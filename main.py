@@ -1,11 +1,11 @@
 from fastapi import FastAPI, Request, Depends, status, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
 
 
 from starlette.responses import StreamingResponse, Response
 from pydantic import BaseModel, ConfigDict
-from typing import List, Union, Generator, Iterator
+from typing import List, Union, Iterator, AsyncIterator
 
 
 from utils.pipelines.auth import bearer_security, get_current_user
@@ -21,6 +21,7 @@ import shutil
 import aiohttp
 import os
 import importlib.util
+import inspect
 import logging
 import time
 import json
@@ -649,6 +650,76 @@ async def filter_outlet(pipeline_id: str, form_data: FilterForm):
         )
 
 
+def is_stream(res) -> bool:
+    return isinstance(res, (Iterator, AsyncIterator))
+
+
+async def iterate_stream(res) -> AsyncIterator:
+    if isinstance(res, AsyncIterator):
+        async for line in res:
+            yield line
+    else:
+        # Sync generators may block on I/O, keep them off the event loop
+        async for line in iterate_in_threadpool(res):
+            yield line
+
+
+def format_stream_line(model: str, line) -> str:
+    if isinstance(line, BaseModel):
+        line = line.model_dump_json()
+        line = f"data: {line}"
+
+    try:
+        line = line.decode("utf-8")
+    except:
+        pass
+
+    logging.info(f"stream_content:Generator:{line}")
+
+    if line.startswith("data:"):
+        return f"{line}\n\n"
+    else:
+        line = stream_message_template(model, line)
+        return f"data: {json.dumps(line)}\n\n"
+
+
+def stream_finish_message(model: str) -> dict:
+    return {
+        "id": f"{model}-{str(uuid.uuid4())}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+def completion_message(model: str, message: str) -> dict:
+    return {
+        "id": f"{model}-{str(uuid.uuid4())}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": message,
+                },
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
 async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
@@ -664,117 +735,70 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
             detail=f"Pipeline {form_data.model} not found",
         )
 
-    def job():
-        print(form_data.model)
+    print(form_data.model)
 
-        pipeline = app.state.PIPELINES[form_data.model]
-        pipeline_id = form_data.model
+    pipeline = app.state.PIPELINES[form_data.model]
+    pipeline_id = form_data.model
 
-        print(pipeline_id)
+    print(pipeline_id)
 
-        if pipeline["type"] == "manifold":
-            manifold_id, pipeline_id = pipeline_id.split(".", 1)
-            pipe = PIPELINE_MODULES[manifold_id].pipe
-        else:
-            pipe = PIPELINE_MODULES[pipeline_id].pipe
+    if pipeline["type"] == "manifold":
+        manifold_id, pipeline_id = pipeline_id.split(".", 1)
+        pipe = PIPELINE_MODULES[manifold_id].pipe
+    else:
+        pipe = PIPELINE_MODULES[pipeline_id].pipe
+
+    async def run_pipe():
+        kwargs = dict(
+            user_message=user_message,
+            model_id=pipeline_id,
+            messages=messages,
+            body=form_data.model_dump(),
+        )
+        # Async pipes run on the event loop, sync ones in a worker thread
+        if inspect.iscoroutinefunction(pipe):
+            return await pipe(**kwargs)
+        return await run_in_threadpool(pipe, **kwargs)
 
-        if form_data.stream:
+    res = await run_pipe()
 
-            def stream_content():
-                res = pipe(
-                    user_message=user_message,
-                    model_id=pipeline_id,
-                    messages=messages,
-                    body=form_data.model_dump(),
-                )
+    if form_data.stream:
+        logging.info(f"stream:true:{res}")
 
-                logging.info(f"stream:true:{res}")
-
-                if isinstance(res, str):
-                    message = stream_message_template(form_data.model, res)
-                    logging.info(f"stream_content:str:{message}")
-                    yield f"data: {json.dumps(message)}\n\n"
-
-                if isinstance(res, Iterator):
-                    for line in res:
-                        if isinstance(line, BaseModel):
-                            line = line.model_dump_json()
-                            line = f"data: {line}"
-
-                        try:
-                            line = line.decode("utf-8")
-                        except:
-                            pass
-
-                        logging.info(f"stream_content:Generator:{line}")
-
-                        if line.startswith("data:"):
-                            yield f"{line}\n\n"
-                        else:
-                            line = stream_message_template(form_data.model, line)
-                            yield f"data: {json.dumps(line)}\n\n"
-
-                if isinstance(res, str) or isinstance(res, Generator):
-                    finish_message = {
-                        "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": form_data.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "logprobs": None,
-                                "finish_reason": "stop",
-                            }
-                        ],
-                    }
+        async def stream_content():
+            if isinstance(res, str):
+                message = stream_message_template(form_data.model, res)
+                logging.info(f"stream_content:str:{message}")
+                yield f"data: {json.dumps(message)}\n\n"
 
-                    yield f"data: {json.dumps(finish_message)}\n\n"
-                    yield f"data: [DONE]"
+            if is_stream(res):
+                async for line in iterate_stream(res):
+                    yield format_stream_line(form_data.model, line)
 
-            return StreamingResponse(stream_content(), media_type="text/event-stream")
-        else:
-            res = pipe(
-                user_message=user_message,
-                model_id=pipeline_id,
-                messages=messages,
-                body=form_data.model_dump(),
-            )
-            logging.info(f"stream:false:{res}")
-
-            if isinstance(res, dict):
-                return res
-            elif isinstance(res, BaseModel):
-                return res.model_dump()
-            else:
+            if isinstance(res, str) or is_stream(res):
+                finish_message = stream_finish_message(form_data.model)
 
-                message = ""
+                yield f"data: {json.dumps(finish_message)}\n\n"
+                yield f"data: [DONE]"
 
-                if isinstance(res, str):
-                    message = res
+        return StreamingResponse(stream_content(), media_type="text/event-stream")
+    else:
+        logging.info(f"stream:false:{res}")
 
-                if isinstance(res, Generator):
-                    for stream in res:
-                        message = f"{message}{stream}"
+        if isinstance(res, dict):
+            return res
+        elif isinstance(res, BaseModel):
+            return res.model_dump()
+        else:
 
-                logging.info(f"stream:false:{message}")
-                return {
-                    "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": form_data.model,
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": message,
-                            },
-                            "logprobs": None,
-                            "finish_reason": "stop",
-                        }
-                    ],
-                }
+            message = ""
+
+            if isinstance(res, str):
+                message = res
+
+            if is_stream(res):
+                async for stream in iterate_stream(res):
+                    message = f"{message}{stream}"
 
-    return await run_in_threadpool(job)
+            logging.info(f"stream:false:{message}")
+            return completion_message(form_data.model, message)